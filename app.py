@@ -2,15 +2,11 @@ import streamlit as st
 import pandas as pd
 import data_manager as dm
 import detail_manager as dtlm
-import time
-import cv2
-import numpy as np
-from pyzbar.pyzbar import decode
-from PIL import Image
-from streamlit_webrtc import webrtc_streamer, WebRtcMode, RTCConfiguration
-import av
-import queue
 import threading
+import time
+import itertools
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 # Page configuration
 st.set_page_config(
@@ -26,6 +22,48 @@ STATUS_OPTIONS_RESPONSABLE = ["IMPRESOS", "EN SURTIDO", "EN CAPTURA", "CAPTURADO
 AUTHORIZED_UPLOADERS = ["CHACON SANCHEZ FABIAN RUBISEL", "ESCOBAR RUIZ JOSE MANUEL", "Admin"]
 DASHBOARD_VIEWERS = ["MENDEZ PEREZ JENNYFER", "RUIZ DIAZ CYNTHIA", "MARIO PEREZ AGUILAR", "Admin"]
 
+# Master sheet columns used by the capturista view
+CAPTURISTA_COLUMNS = ("FOLIO", "RUTA", "CAPTURISTA", "ESTATUS", "# FOLIOS DOCUMENTOS")
+
+# Scans are buffered in session state and written in one request once this many are
+# pending, or once the oldest pending scan is this many seconds old
+PENDING_FLUSH_SIZE = 25
+PENDING_FLUSH_SECONDS = 5
+
+# Live camera: decode one frame out of every N, downscaled to this long edge (px)
+DECODE_EVERY_N_FRAMES = 3
+MAX_LIVE_DECODE_SIDE = 640
+# Same QR seen again within this many seconds of its last sighting is not queued again
+QR_REPEAT_WINDOW_S = 2.0
+# Live decodes look at the centre half of the frame; after this many empty
+# decodes in a row, one full-frame decode catches codes held off-centre
+LIVE_ROI_MAX_MISSES = 5
+RECEPTION_REPEAT_WINDOW_S = 2.0
+
+# One peer-connection config for every session (a plain dict, so streamlit_webrtc
+# still only gets imported when the camera is used)
+RTC_CONFIGURATION = {"iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]}
+
+QUOTA_MESSAGE = "Cuota de Google Sheets agotada. Espera un minuto y reintenta."
+UNAVAILABLE_MESSAGE = "Google Sheets no responde. Espera un momento y reintenta."
+
+def retry_message(e):
+    """User message for a dm.QuotaExceeded (or its SheetsUnavailable subclass)."""
+    return UNAVAILABLE_MESSAGE if isinstance(e, dm.SheetsUnavailable) else QUOTA_MESSAGE
+
+def quota_guard(func):
+    """
+    Shows retry_message instead of a traceback when Sheets retries run out.
+    Wraps main_app and each fragment (fragment reruns don't pass through main_app).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except dm.QuotaExceeded as e:
+            st.error(retry_message(e))
+    return wrapper
+
 def init_session_state():
     if "logged_in" not in st.session_state:
         st.session_state.logged_in = False
@@ -34,11 +72,38 @@ def init_session_state():
     if "role" not in st.session_state:
         st.session_state.role = None
 
+def get_users_worksheet():
+    """Users sheet handle; a failed open isn't kept cached, so the next rerun reconnects."""
+    ws = dm.get_or_create_users_worksheet()
+    if not ws:
+        dm.clear_sheet_handles()
+    return ws
+
 def get_users_list():
     """Helper to get users list safely"""
-    ws = dm.get_or_create_users_worksheet()
+    ws = get_users_worksheet()
     if not ws: return []
-    return dm.get_all_users(ws)
+    try:
+        return dm.get_all_users(ws)
+    except dm.QuotaExceeded as e:
+        st.error(retry_message(e))
+        return []
+    except Exception as e:
+        st.error(f"Error reading users: {e}")
+        return []
+
+def get_users_index():
+    """Helper to get the (by_name, by_role) user lookups safely"""
+    ws = get_users_worksheet()
+    if not ws: return {}, {}
+    try:
+        return dm.get_users_index(ws)
+    except dm.QuotaExceeded as e:
+        st.error(retry_message(e))
+        return {}, {}
+    except Exception as e:
+        st.error(f"Error reading users: {e}")
+        return {}, {}
 
 def login_page():
     st.title("📦 Control de Pickings - Acceso")
@@ -78,7 +143,8 @@ def login_page():
             
             if submitted:
                 # Find the user record
-                user_record = next((u for u in users_data if u["USUARIO"] == selected_user), None)
+                users_by_name, _ = get_users_index()
+                user_record = users_by_name.get(selected_user)
                 if user_record:
                     st.session_state.logged_in = True
                     st.session_state.user = user_record["USUARIO"]
@@ -87,15 +153,44 @@ def login_page():
                 else:
                     st.error("Error al identificar usuario.")
 
+@quota_guard
 def main_app():
     st.sidebar.title(f"Hola, {st.session_state.user}")
     st.sidebar.badge(st.session_state.role)
     
-    if st.sidebar.button("Cerrar Sesión"):
-        st.session_state.logged_in = False
-        st.session_state.user = None
-        st.session_state.role = None
+    # Sheet reads are cached for minutes; this picks up edits made outside the app
+    if st.sidebar.button("🔄 Refrescar datos"):
+        dm.clear_data_cache()
+        dm.clear_users_cache()
+        dm.get_folio_rows.clear()
+        dtlm.clear_detail_cache()
+        for key in [k for k in st.session_state if k.startswith("qrset_")]:
+            del st.session_state[key]
         st.rerun()
+    
+    # Deletions only flag rows; this removes them from the sheets
+    if st.session_state.role == "RESPONSABLE" and st.sidebar.button("🧹 Depurar eliminados"):
+        results = [
+            dtlm.purge_deleted_qrs(dtlm.get_or_create_detail_worksheet()),
+            dm.purge_deleted_rows(dm.get_or_create_users_worksheet()),
+        ]
+        dtlm.clear_detail_cache()
+        dm.clear_users_cache()
+        for success, msg in results:
+            st.toast(msg, icon="✅" if success else "❌")
+    
+    if st.sidebar.button("Cerrar Sesión"):
+        # Buffered scans only live in this session; write them before it ends
+        success, msg = drain_pending_qrs(dtlm.get_or_create_detail_worksheet())
+        if success:
+            st.session_state.logged_in = False
+            st.session_state.user = None
+            st.session_state.role = None
+            st.rerun()
+        st.sidebar.error(f"No se pudieron guardar los escaneos pendientes: {msg}")
+
+    # Report background writes submitted on earlier reruns
+    poll_write_jobs()
 
     # Connection to Google Sheets
     # client = dm.get_gspread_client() # No longer needed here
@@ -104,19 +199,23 @@ def main_app():
     detail_worksheet = dtlm.get_or_create_detail_worksheet()
     
     if not worksheet or not detail_worksheet:
+        # Don't keep a failed handle cached; next rerun retries the connection
+        dm.clear_sheet_handles()
+        dtlm.get_or_create_detail_worksheet.clear()
         st.error("No se pudo acceder a las hojas de cálculo.")
         st.stop()
 
-    # Load Data
-    with st.spinner("Cargando datos..."):
-        df = dm.load_data(worksheet)
-
     if st.session_state.role == "RESPONSABLE":
-        responsable_view(df, worksheet, detail_worksheet)
+        # The full master sheet is loaded inside the view, only where it is shown
+        responsable_view(worksheet, detail_worksheet, get_users_list(), get_users_index()[1])
     else:
+        # Load Data (capturistas only need their own rows, and only the columns their list shows)
+        with st.spinner("Cargando datos..."):
+            df = dm.load_data_for_user(worksheet, st.session_state.user, CAPTURISTA_COLUMNS)
+        pending_writes_timer(detail_worksheet)
         capturista_view(df, worksheet, detail_worksheet)
 
-def responsable_view(df, worksheet, detail_worksheet):
+def responsable_view(worksheet, detail_worksheet, users_data, users_by_role):
     st.title("Panel de Responsable")
     
     # We need to access users worksheet for the new tab
@@ -139,24 +238,27 @@ def responsable_view(df, worksheet, detail_worksheet):
     with tabs[0]:
         st.subheader("Tablero General")
         
+        with st.spinner("Cargando datos..."):
+            df = dm.load_data(worksheet)
+        
         # Filters
         col1, col2, col3 = st.columns(3)
         with col1:
-            filter_status = st.multiselect("Filtrar por Estatus", options=df["ESTATUS"].unique())
+            filter_status = st.multiselect("Filtrar por Estatus", options=df["ESTATUS"].cat.categories.tolist())
         with col2:
-            filter_capturista = st.multiselect("Filtrar por Capturista", options=df["CAPTURISTA"].unique())
+            filter_capturista = st.multiselect("Filtrar por Capturista", options=df["CAPTURISTA"].cat.categories.tolist())
         with col3:
             search_folio = st.text_input("Buscar Folio")
             
-        filtered_df = df.copy()
+        # Compose one boolean mask on the loaded frame and slice once instead of copying per filter
+        mask = pd.Series(True, index=df.index)
         if filter_status:
-            filtered_df = filtered_df[filtered_df["ESTATUS"].isin(filter_status)]
+            mask &= df["ESTATUS"].isin(filter_status)
         if filter_capturista:
-            filtered_df = filtered_df[filtered_df["CAPTURISTA"].isin(filter_capturista)]
+            mask &= df["CAPTURISTA"].isin(filter_capturista)
         if search_folio:
-            filtered_df = filtered_df[filtered_df["FOLIO"].astype(str).str.contains(search_folio, case=False)]
-            
-        st.dataframe(filtered_df, use_container_width=True)
+            mask &= df["FOLIO"].str.contains(search_folio, case=False, regex=False, na=False)
+        st.dataframe(df.loc[mask], use_container_width=True)
 
     # Dynamic Tab Content handling
     current_tab_idx = 1
@@ -173,8 +275,8 @@ def responsable_view(df, worksheet, detail_worksheet):
                     with st.spinner("Procesando y sincronizando..."):
                         success, msg = dm.sync_excel_data(worksheet, uploaded_file)
                         if success:
-                            st.success(msg)
-                            time.sleep(2)
+                            dm.clear_data_cache()
+                            st.toast(msg, icon="✅")
                             st.rerun()
                         else:
                             st.error(msg)
@@ -186,8 +288,8 @@ def responsable_view(df, worksheet, detail_worksheet):
             st.subheader("Indicadores de Desempeño (KPI)")
             
             # Simple KPIs based on ESTATUS
-            total_pickings = len(df)
-            status_counts = df["ESTATUS"].value_counts()
+            status_counts, capturista_counts = dm.get_kpis(worksheet)
+            total_pickings = int(status_counts.sum())
             
             kpi1, kpi2, kpi3 = st.columns(3)
             kpi1.metric("Total Pickings", total_pickings)
@@ -197,37 +299,13 @@ def responsable_view(df, worksheet, detail_worksheet):
             st.bar_chart(status_counts)
             
             st.subheader("Avance por Capturista")
-            capturista_counts = df.groupby(["CAPTURISTA", "ESTATUS"]).size().unstack(fill_value=0)
             st.dataframe(capturista_counts, use_container_width=True)
             
         current_tab_idx += 1
 
     # 4. Recepción Almacén (New Quick Scan)
     with tabs[current_tab_idx]:
-        st.subheader("Recepción de Almacén (Escaneo Rápido)")
-        st.markdown("Escanea los documentos para agregarlos al folio y sumar el contador.")
-        
-        # Similar logic to detail scan but updating master columns
-        qr_reception = st.text_input("Escanear Picking (QR)", key="reception_scan")
-        
-        if qr_reception:
-            # Parse to get folio parent? Or assume QR contains folio?
-            # User said: "automaticamnte el folio se debe de buscar y agregar... separados por un espacio"
-            # Assuming QR string contains the folio ID somewhere or matches the FOLIO column if partial.
-            # Let's try to extract FOLIO from QR if format is known (FOLIO|...).
-            
-            # Using our helper
-            folio_found, _ = dtlm.parse_qr_code(qr_reception)
-            
-            if folio_found:
-                 # Call new data_manager function
-                 success, msg = dm.increment_folio_count(worksheet, folio_found, qr_reception)
-                 if success:
-                     st.success(msg)
-                 else:
-                     st.error(msg)
-            else:
-                st.warning("Formato de QR no reconocido.")
+        reception_scan(worksheet, dm.get_folio_set(worksheet))
     
     current_tab_idx += 1
     
@@ -237,11 +315,10 @@ def responsable_view(df, worksheet, detail_worksheet):
         
         c1, c2 = st.columns(2)
         with c1:
-            folio_to_assign = st.selectbox("Seleccionar Folio", df["FOLIO"].unique())
+            folio_to_assign = st.selectbox("Seleccionar Folio", dm.get_folio_options(worksheet))
         with c2:
             # Dynamic users list
-            current_users = get_users_list()
-            capturistas = [u["USUARIO"] for u in current_users if u["ROL"] == "CAPTURISTA"]
+            capturistas = users_by_role.get("CAPTURISTA", [])
             # Fallback if no capturistas
             if not capturistas: capturistas = ["Sin Capturistas"]
             target_user = st.selectbox("Asignar a", capturistas)
@@ -249,8 +326,8 @@ def responsable_view(df, worksheet, detail_worksheet):
         if st.button("Reasignar"):
             success, msg = dm.reassign_capturista(worksheet, str(folio_to_assign), target_user, st.session_state.user)
             if success:
-                st.success(msg)
-                time.sleep(1)
+                dm.clear_data_cache()
+                st.toast(msg, icon="✅")
                 st.rerun()
             else:
                 st.error(msg)
@@ -271,8 +348,8 @@ def responsable_view(df, worksheet, detail_worksheet):
                 if new_user_name:
                     success, msg = dm.add_user(users_ws, new_user_name, new_user_role)
                     if success:
-                        st.success(msg)
-                        time.sleep(1)
+                        dm.clear_users_cache()
+                        st.toast(msg, icon="✅")
                         st.rerun()
                     else:
                         st.error(msg)
@@ -283,49 +360,111 @@ def responsable_view(df, worksheet, detail_worksheet):
         st.subheader("Lista de Usuarios")
         
         # Show users list with delete option
-        all_users = dm.get_all_users(users_ws)
-        if all_users:
-            users_df = pd.DataFrame(all_users)
+        if users_data:
+            # One editable table instead of a row of widgets per user
+            users_df = pd.DataFrame(users_data)[["USUARIO", "ROL"]].assign(Eliminar=False)
+            editor_key = f"users_editor_{st.session_state.get('users_editor_version', 0)}"
+            edited_users = st.data_editor(
+                users_df,
+                key=editor_key,
+                hide_index=True,
+                use_container_width=True,
+                disabled=["USUARIO", "ROL"],
+                column_config={"Eliminar": st.column_config.CheckboxColumn("Eliminar")},
+            )
             
-            # Simple list
-            for idx, u in users_df.iterrows():
-                u_name = u["USUARIO"]
-                u_role = u["ROL"]
-                
-                col_u1, col_u2, col_u3 = st.columns([2, 2, 1])
-                with col_u1:
-                    st.write(f"**{u_name}**")
-                with col_u2:
-                    st.badge(u_role)
-                with col_u3:
-                    if u_name != "Admin":
-                        if st.button("Eliminar", key=f"del_user_{u_name}"):
-                            success, msg = dm.delete_user(users_ws, u_name)
-                            if success:
-                                st.rerun()
-                            else:
-                                st.error(msg)
-
-def decode_image(image_file):
+            to_delete = [u for u in edited_users.loc[edited_users["Eliminar"], "USUARIO"] if u != "Admin"]
+            if st.button("🗑️ Eliminar seleccionados", disabled=not to_delete):
+                errors = []
+                for u_name in to_delete:
+                    success, msg = dm.delete_user(users_ws, u_name)
+                    if not success:
+                        errors.append(f"{u_name}: {msg}")
+                dm.clear_users_cache()
+                st.session_state.users_editor_version = st.session_state.get("users_editor_version", 0) + 1
+                if errors:
+                    st.error("\n".join(errors))
+                else:
+                    st.rerun()
+
+@st.fragment
+@quota_guard
+def reception_scan(worksheet, valid_folios):
     """
-    Decodes QR codes from an image file.
+    Warehouse reception scanner. Runs as a fragment so each scan only reruns this block.
     """
-    try:
-        # Convert the file to an opencv image
-        file_bytes = np.asarray(bytearray(image_file.read()), dtype=np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-        
-        # Decode QR codes
-        decoded_objects = decode(img)
+    st.subheader("Recepción de Almacén (Escaneo Rápido)")
+    st.markdown("Escanea los documentos para agregarlos al folio y sumar el contador.")
+    
+    # Similar logic to detail scan but updating master columns
+    qr_reception = st.text_input("Escanear Picking (QR)", key="reception_scan")
+    
+    if qr_reception:
+        # Parse to get folio parent? Or assume QR contains folio?
+        # User said: "automaticamnte el folio se debe de buscar y agregar... separados por un espacio"
+        # Assuming QR string contains the folio ID somewhere or matches the FOLIO column if partial.
+        # Let's try to extract FOLIO from QR if format is known (FOLIO|...).
+    
+        # Using our helper
+        folio_found, _ = dtlm.parse_qr_code(qr_reception)
         
-        results = []
-        for obj in decoded_objects:
-            results.append(obj.data.decode("utf-8"))
-            
-        return results
-    except Exception as e:
-        st.error(f"Error decoding image: {e}")
-        return []
+        # Scanners can fire the same code twice in a row; don't write it twice
+        now = time.time()
+        last_qr, last_t = st.session_state.get("last_reception", (None, 0.0))
+        repeated = qr_reception == last_qr and now - last_t < RECEPTION_REPEAT_WINDOW_S
+    
+        if not folio_found:
+            st.warning("Formato de QR no reconocido.")
+        elif folio_found not in valid_folios and not dm.locate_folio(worksheet, folio_found)[1]:
+            # Checked against the loaded folios so unknown codes never reach the sheet.
+            # That list can be minutes old; locate_folio re-reads the FOLIO column on a miss
+            # (at most every few seconds), so folios just uploaded from another session are accepted
+            st.warning("Folio no registrado.")
+        elif not repeated:
+             st.session_state.last_reception = (qr_reception, now)
+             # Call new data_manager function
+             success, msg = dm.increment_folio_count(worksheet, folio_found, qr_reception)
+             if success:
+                 dm.clear_data_cache()
+                 st.success(msg)
+             else:
+                 st.error(msg)
+
+# OpenCV objects keep internal buffers, so each thread (one per session, plus the
+# WebRTC frame threads) gets its own instance, built once and reused.
+_cv_local = threading.local()
+
+def get_qr_detector():
+    """OpenCV's native QR detector for the current thread."""
+    if not hasattr(_cv_local, "detector"):
+        import cv2
+        _cv_local.detector = cv2.QRCodeDetector()
+    return _cv_local.detector
+
+def decode_qr(gray):
+    """
+    Decodes QR codes from a grayscale image with OpenCV's detector.
+    """
+    found, texts, _, _ = get_qr_detector().detectAndDecodeMulti(gray)
+    return [t for t in texts if t] if found else []
+
+def decode_live_frame(gray, full_frame=False):
+    """
+    Decodes a grayscale camera frame on a small copy (centre ROI unless full_frame).
+    OpenCV only: most live frames hold no code, so a second decoder would double the cost.
+    """
+    import cv2
+    
+    if not full_frame:
+        # Codes are aimed at the middle of the view; a quarter of the pixels to scan.
+        # Slicing is a view, so nothing is copied until the resize
+        h, w = gray.shape[:2]
+        gray = gray[h // 4:3 * h // 4, w // 4:3 * w // 4]
+    h, w = gray.shape[:2]
+    scale = MAX_LIVE_DECODE_SIDE / max(h, w)
+    if scale < 1:
+        gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return decode_qr(gray)
 
 def capturista_view(df, worksheet, detail_worksheet):
     st.title("Panel de Capturista")
@@ -334,14 +473,13 @@ def capturista_view(df, worksheet, detail_worksheet):
     if "selected_folio" not in st.session_state:
         st.session_state.selected_folio = None
 
-    # Filter for current user
-    my_pickings = df[df["CAPTURISTA"] == st.session_state.user].copy()
-    
     if st.session_state.selected_folio:
         # DETAIL VIEW
         show_folio_detail(st.session_state.selected_folio, detail_worksheet, worksheet)
     else:
         # MASTER VIEW (List)
+        # Filter for current user (read-only below, so no copy)
+        my_pickings = df.loc[df["CAPTURISTA"] == st.session_state.user]
         if my_pickings.empty:
             st.info("No tienes pickings asignados actualmente.")
             return
@@ -352,70 +490,174 @@ def capturista_view(df, worksheet, detail_worksheet):
         # We need to show count of documents (from # FOLIOS DOCUMENTOS column)
         # And status dropdown
         
-        # Optimized: Get all detail counts at once to avoid querying inside loop
-        # Note: We need to implement get_all_detail_counts in detail_manager
-        # For now, let's assume we can fetch it. If not implemented, we skip or do it slow.
+        # Optimized: Get all detail counts at once (single cached sheet read)
         try:
             detail_counts = dtlm.get_all_detail_counts(detail_worksheet)
-        except AttributeError:
-            detail_counts = {}
+        except dm.QuotaExceeded:
+            raise
+        except Exception as e:
+            st.error(f"Error fetching details: {e}")
+            detail_counts = pd.Series(dtype="int64")
         
-        for index, row in my_pickings.iterrows():
-            folio = row['FOLIO']
-            current_status = row['ESTATUS']
-            
-            # Count from Warehouse (Master)
-            doc_count_warehouse = row['# FOLIOS DOCUMENTOS'] if row['# FOLIOS DOCUMENTOS'] else 0
-            
-            # Count from Capturista (Detail)
-            doc_count_scanned = detail_counts.get(str(folio), 0)
-            
-            # Card-like container
-            with st.container():
-                col1, col2, col3, col4 = st.columns([3, 1, 2, 1])
-                with col1:
-                    st.write(f"**Folio:** {folio}")
-                    st.caption(f"Ruta: {row['RUTA']}")
-                
-                with col2:
-                    # Dual metric
-                    st.write(f"📦 Almacén: **{doc_count_warehouse}**")
-                    st.write(f"✅ Escaneados: **{doc_count_scanned}**")
-                    
-                with col3:
-                    # Status Dropdown
-                    # We need a unique key. If user changes this, it updates DB.
-                    try:
-                        idx_status = STATUS_OPTIONS_CAPTURISTA.index(current_status)
-                    except ValueError:
-                        idx_status = 0
-                        
-                    new_status = st.selectbox(
-                        "Estatus", 
-                        STATUS_OPTIONS_CAPTURISTA, 
-                        index=idx_status, 
-                        key=f"status_{folio}",
-                        label_visibility="collapsed"
-                    )
-                    
-                    if new_status != current_status:
-                        # Update DB immediately
-                        dm.update_status(worksheet, folio, new_status, st.session_state.user)
-                        st.toast(f"Estatus actualizado: {new_status}")
-                        # Invalidate cache to reflect change
-                        dm.load_data.clear()
-                        # We don't need to sleep here if we clear cache, rerunning will fetch fresh data
-                        st.rerun()
+        # Single editable grid instead of one row of widgets per picking.
+        # Warehouse count comes from the master sheet, scanned count from the detail sheet.
+        table_df = my_pickings[["FOLIO", "RUTA"]].assign(**{
+            "ESTATUS": my_pickings["ESTATUS"].astype(str),
+            "📦 Almacén": my_pickings["# FOLIOS DOCUMENTOS"],
+            "✅ Escaneados": my_pickings["FOLIO"].map(detail_counts).fillna(0).astype(int),
+            "Abrir": False,
+        })
+        
+        # Versioned key: bumping it after applying edits gives a fresh editor
+        editor_key = f"pickings_editor_{st.session_state.get('pickings_editor_version', 0)}"
+        st.data_editor(
+            table_df,
+            key=editor_key,
+            hide_index=True,
+            use_container_width=True,
+            disabled=["FOLIO", "RUTA", "📦 Almacén", "✅ Escaneados"],
+            column_config={
+                "ESTATUS": st.column_config.SelectboxColumn("Estatus", options=STATUS_OPTIONS_CAPTURISTA, required=True),
+                "Abrir": st.column_config.CheckboxColumn("Abrir"),
+            }
+        )
+        
+        # Only rows the user touched are written back
+        edited_rows = st.session_state[editor_key]["edited_rows"]
+        if not edited_rows:
+            return
+        
+        folio_to_open = None
+        new_statuses = {}
+        for pos, changes in edited_rows.items():
+            folio = table_df.iloc[int(pos)]["FOLIO"]
+            new_status = changes.get("ESTATUS")
+            if new_status and new_status != table_df.iloc[int(pos)]["ESTATUS"]:
+                new_statuses[folio] = new_status
+            if changes.get("Abrir"):
+                folio_to_open = folio
+        
+        if new_statuses:
+            # All changed rows go out in one request
+            success, msg = dm.update_status_bulk(worksheet, new_statuses, st.session_state.user)
+            if success:
+                st.toast(f"Estatus actualizado en {len(new_statuses)} folio(s)")
+            else:
+                st.toast(msg, icon="⚠️")
+            # Invalidate cache to reflect change
+            dm.clear_data_cache()
+        st.session_state.pickings_editor_version = st.session_state.get("pickings_editor_version", 0) + 1
+        if folio_to_open:
+            st.session_state.selected_folio = folio_to_open
+        st.rerun()
 
-                with col4:
-                    if st.button("Abrir", key=f"btn_{folio}"):
-                        st.session_state.selected_folio = folio
-                        st.rerun()
-                
-                st.divider()
+def invalidate_folio_details(folio):
+    """Clears cached detail data after a QR is registered or deleted."""
+    dtlm.clear_detail_cache()
+    st.session_state.pop(f"qrset_{folio}", None)
+
+def flush_pending_qrs(detail_worksheet):
+    """
+    Hands buffered scans to the background writer.
+    They stay buffered (and visible) until poll_write_jobs sees the write succeed.
+    """
+    pending = st.session_state.get("pending_qrs", [])
+    if not pending or st.session_state.get("qr_flush_job"):
+        return
+    
+    batch = list(pending)
+    future = dm.submit_write(dtlm.register_qr_scans, detail_worksheet, batch)
+    st.session_state.qr_flush_job = (future, batch)
+
+def poll_write_jobs():
+    """
+    Reports the background QR write started on a previous rerun once it has finished.
+    Returns True if a write finished on this call.
+    """
+    job = st.session_state.get("qr_flush_job")
+    if not job or not job[0].done():
+        return False
+    
+    future, batch = job
+    st.session_state.qr_flush_job = None
+    try:
+        success, msg = future.result()
+    except dm.QuotaExceeded as e:
+        success, msg = False, retry_message(e) # Scans stay buffered for the next flush
+    if success:
+        written = {row[0] for row in batch}
+        st.session_state.pending_qrs = [row for row in st.session_state.pending_qrs if row[0] not in written]
+        for folio in {row[1] for row in batch}:
+            invalidate_folio_details(folio)
+        st.toast(msg, icon="✅")
+    else:
+        st.error(msg)
+    return True
+
+def drain_pending_qrs(detail_worksheet):
+    """
+    Writes every buffered scan and waits for the result, e.g. before logging out.
+    Returns (success, msg); on failure the scans stay buffered.
+    """
+    job = st.session_state.get("qr_flush_job")
+    if job:
+        job[0].exception() # Wait (without raising); poll_write_jobs then drops what it wrote from the buffer
+        poll_write_jobs()
+    pending = st.session_state.get("pending_qrs", [])
+    if not pending:
+        return True, ""
+    
+    batch = list(pending)
+    try:
+        success, msg = dm.submit_write(dtlm.register_qr_scans, detail_worksheet, batch).result()
+    except dm.QuotaExceeded as e:
+        return False, retry_message(e)
+    if success:
+        written = {row[0] for row in batch}
+        st.session_state.pending_qrs = [row for row in st.session_state.pending_qrs if row[0] not in written]
+        for folio in {row[1] for row in batch}:
+            invalidate_folio_details(folio)
+    return success, msg
+
+def maybe_flush_pending_qrs(detail_worksheet):
+    """Flushes the scan buffer when it is full or its oldest scan has waited long enough."""
+    pending = st.session_state.get("pending_qrs", [])
+    if not pending:
+        return
+    waited = time.monotonic() - st.session_state.get("pending_since", 0)
+    if len(pending) >= PENDING_FLUSH_SIZE or waited >= PENDING_FLUSH_SECONDS:
+        flush_pending_qrs(detail_worksheet)
+
+@st.fragment(run_every=PENDING_FLUSH_SECONDS)
+@quota_guard
+def pending_writes_timer(detail_worksheet):
+    """
+    Reruns on a timer so a buffer that stopped growing is still flushed (and the
+    result reported) while the user is idle, not only on the next interaction.
+    """
+    if not st.session_state.get("pending_qrs") and not st.session_state.get("qr_flush_job"):
+        return
+    maybe_flush_pending_qrs(detail_worksheet)
+    if poll_write_jobs():
+        st.rerun() # Refresh the folio list and counters with the written scans
 
+def back_to_list(detail_worksheet):
+    flush_pending_qrs(detail_worksheet)
+    # The camera connection outlives the folio; drop scans it queued for this one
+    if "qr_slot" in st.session_state:
+        st.session_state.qr_slot[0] = None
+        st.session_state.qr_ready.clear()
+    st.session_state.selected_folio = None
+
+@st.fragment
+@quota_guard
 def show_folio_detail(folio, detail_worksheet, master_worksheet):
-    st.button("⬅️ Volver al listado", on_click=lambda: st.session_state.update({"selected_folio": None}))
+    # Fragment: scans, deletes and syncs rerun only this view, not main_app
+    if st.button("⬅️ Volver al listado"):
+        back_to_list(detail_worksheet)
+        st.rerun() # Leaving the folio needs a full app rerun
+    
+    poll_write_jobs()
     
     st.header(f"Gestión de Folio: {folio}")
     
@@ -424,10 +666,38 @@ def show_folio_detail(folio, detail_worksheet, master_worksheet):
     # Assuming we have access to master_worksheet here. Need to pass it in.
     
     # Fetch existing details
-    details_df = dtlm.get_folio_details(detail_worksheet, folio)
+    try:
+        details_df = dtlm.get_folio_details(detail_worksheet, folio)
+    except dm.QuotaExceeded:
+        raise
+    except Exception as e:
+        # The folio's QR set is built from these rows; scanning against an empty one
+        # would let duplicates through, so wait for a good read
+        st.error(f"Error fetching details: {e}")
+        return
     count_scanned = len(details_df) if not details_df.empty else 0
     
-    st.metric("Documentos Escaneados", count_scanned)
+    if "pending_qrs" not in st.session_state:
+        st.session_state.pending_qrs = []
+    pending_qrs = st.session_state.pending_qrs
+    
+    # Set of QRs already in this folio, for O(1) duplicate checks across reruns.
+    # Scans still buffered or being written aren't in the sheet yet, but count too
+    qrset_key = f"qrset_{folio}"
+    if qrset_key not in st.session_state:
+        unsaved = list(pending_qrs)
+        job = st.session_state.get("qr_flush_job")
+        if job:
+            unsaved += job[1]
+        qr_set = {row[0] for row in unsaved if row[1] == folio}
+        if not details_df.empty and "QR_DATA" in details_df.columns:
+            qr_set.update(details_df["QR_DATA"].astype(str))
+        st.session_state[qrset_key] = frozenset(qr_set)
+    qr_set = st.session_state[qrset_key]
+    
+    # Filled at the end of the run, once this run's scan (if any) is buffered,
+    # so a scan doesn't need another rerun to show up in the counters
+    summary = st.container()
     
     col_scan, col_list = st.columns([1, 1])
     
@@ -439,35 +709,68 @@ def show_folio_detail(folio, detail_worksheet, master_worksheet):
         qr_data_found = None
         
         if input_method == "Cámara":
-            # Real-time WebRTC Scanner
-            RTC_CONFIGURATION = RTCConfiguration(
-                {"iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]}
-            )
+            # Real-time WebRTC Scanner (imported here; only the camera path needs it)
+            from streamlit_webrtc import webrtc_streamer, WebRtcMode
 
-            # Define a thread-safe queue in session state
-            if "qr_queue" not in st.session_state:
-                st.session_state.qr_queue = queue.Queue()
+            # Single slot holding the latest unread QR, plus an Event flagging that it's
+            # full. The consumer only ever needs one, and a list item swap is atomic under
+            # the GIL, so no lock on the frame thread.
+            # The callback runs on a WebRTC worker thread without access to
+            # st.session_state, so it gets both through the closure
+            if "qr_slot" not in st.session_state:
+                st.session_state.qr_slot = [None]
+                st.session_state.qr_ready = threading.Event()
+            qr_slot = st.session_state.qr_slot
+            qr_ready = st.session_state.qr_ready
+            frame_counter = itertools.count()
+            # Last emitted QR, kept across reruns so a code held in view is queued once
+            last_seen = st.session_state.setdefault("qr_last_seen", {"text": None, "ts": 0.0})
+            # One decode at a time on a per-session worker, off the WebRTC frame thread
+            if "qr_decode_pool" not in st.session_state:
+                st.session_state.qr_decode_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qr-decode")
+            decode_pool = st.session_state.qr_decode_pool
+            decode_job = st.session_state.setdefault("qr_decode_job", {"future": None, "misses": 0})
 
             def video_frame_callback(frame):
-                img = frame.to_ndarray(format="bgr24")
-                
-                # Decode QR
-                decoded_objects = decode(img)
-                
-                for obj in decoded_objects:
-                    qr_text = obj.data.decode("utf-8")
-                    # Put in queue
+                # Collect the result of the previous decode, if it has finished
+                job = decode_job["future"]
+                if job is not None and job.done():
+                    decode_job["future"] = None
                     try:
-                        st.session_state.qr_queue.put_nowait(qr_text)
-                    except queue.Full:
-                        pass
+                        decoded_texts = job.result()
+                    except Exception:
+                        decoded_texts = []
+                    decode_job["misses"] = 0 if decoded_texts else decode_job["misses"] + 1
+                    
+                    now = time.monotonic()
+                    for qr_text in decoded_texts:
+                        if qr_text == last_seen["text"] and now - last_seen["ts"] < QR_REPEAT_WINDOW_S:
+                            # Rolling window: every sighting extends it, so a held code is queued once
+                            last_seen["ts"] = now
+                            continue
+                        # Other codes in the same frame stay unseen and are picked up by a later decode
+                        if not qr_ready.is_set():
+                            qr_slot[0] = qr_text
+                            qr_ready.set()
+                            last_seen["text"], last_seen["ts"] = qr_text, now
+                
+                # Start a decode on every Nth frame, unless one is still running or a
+                # previous result is waiting to be consumed. Decoding happens on the
+                # worker, so this thread returns the frame right away.
+                if (next(frame_counter) % DECODE_EVERY_N_FRAMES == 0
+                        and decode_job["future"] is None and not qr_ready.is_set()):
+                    full_frame = decode_job["misses"] >= LIVE_ROI_MAX_MISSES
+                    if full_frame:
+                        decode_job["misses"] = 0
+                    decode_job["future"] = decode_pool.submit(decode_live_frame, frame.to_ndarray(format="gray"), full_frame)
                 
-                # Return frame (can draw box here if needed)
-                return av.VideoFrame.from_ndarray(img, format="bgr24")
+                return frame
 
             # WebRTC Component
             ctx = webrtc_streamer(
-                key=f"scanner_{folio}",
+                # Same key for every folio: switching folios keeps the connection
+                # instead of renegotiating ICE. Scans are tied to the folio on consumption.
+                key="qr_scanner",
                 mode=WebRtcMode.SENDRECV,
                 rtc_configuration=RTC_CONFIGURATION,
                 video_frame_callback=video_frame_callback,
@@ -475,13 +778,11 @@ def show_folio_detail(folio, detail_worksheet, master_worksheet):
                 async_processing=True,
             )
 
-            # Check queue for results
-            if ctx.state.playing:
-                try:
-                    # Non-blocking get
-                    qr_data_found = st.session_state.qr_queue.get_nowait()
-                except queue.Empty:
-                    qr_data_found = None
+            # Take the latest result, if any, and free the slot. The callback only
+            # writes while the flag is clear, so clearing it here can't drop a new result.
+            if ctx.state.playing and qr_ready.is_set():
+                qr_data_found, qr_slot[0] = qr_slot[0], None
+                qr_ready.clear()
             
         else:
             # USB Reader input - auto submit on enter
@@ -494,26 +795,37 @@ def show_folio_detail(folio, detail_worksheet, master_worksheet):
             # But we should check if the QR string *contains* the folio if possible, or just trust the user.
             # User said: "nutriendo el registro del folio... esos Qr que escanearia se agregaria"
             
-            # Check if exists locally in the dataframe first to give fast feedback
-            already_exists = False
-            if not details_df.empty and "QR_DATA" in details_df.columns:
-                 if qr_data_found in details_df["QR_DATA"].values:
-                     already_exists = True
-            
-            if already_exists:
+            # Check if exists locally first to give fast feedback; the sheet-wide set
+            # also catches QRs already registered under another folio
+            repeated = qr_data_found in qr_set
+            if not repeated:
+                try:
+                    repeated = qr_data_found in dtlm.get_registered_qrs(detail_worksheet)
+                except dm.QuotaExceeded:
+                    raise
+                except Exception as e:
+                    # Not fatal: the flush checks the sheet again before writing
+                    print(f"Error reading registered QRs: {e}")
+            if repeated:
                 # Use toast for less intrusive warning
                 st.toast(f"⚠️ QR Repetido: {qr_data_found}", icon="⚠️")
             else:
                 # We force the association with the current folio since we are inside the folio view
-                success, msg = dtlm.register_qr_scan(
-                    detail_worksheet, 
+                new_row = dtlm.build_qr_row(
                     qr_data_found, 
                     st.session_state.user, 
                     status="SURTIDO",
                     forced_folio=folio
                 )
-                if success:
-                    st.toast(f"✅ Agregado: {qr_data_found}", icon="✅")
+                if new_row:
+                    # Buffer the scan; the sheet is written once per PENDING_FLUSH_SIZE scans
+                    if not pending_qrs:
+                        st.session_state.pending_since = time.monotonic()
+                    pending_qrs.append(new_row)
+                    # Buffered scans count as present for the local duplicate check
+                    qr_set = st.session_state[qrset_key] = qr_set | {qr_data_found}
+                    # Not in the sheet yet: poll_write_jobs confirms once the batch is written
+                    st.toast(f"⏳ En cola: {qr_data_found}", icon="⏳")
                     
                     # Update master count if possible?
                     # Since we are adding to detail, the master count (which is for Warehouse reception) 
@@ -524,32 +836,59 @@ def show_folio_detail(folio, detail_worksheet, master_worksheet):
                     # We need to invalidate master cache so it re-reads if we updated it?
                     # But we are NOT updating master sheet here yet. 
                     
-                    # For now, just rerun to update Detail View list.
+                    # The list and counters below are rendered after this point, so they
+                    # already include the new scan; no rerun needed.
                     # Ideally, we should sync this count to master sheet or read from details.
-                    
-                    time.sleep(0.5) # Brief pause to show success
-                    st.rerun() # Rerun to update list immediately
                 else:
-                    st.error(msg)
+                    st.error("Formato de QR inválido o no legible.")
 
+    # Any rerun of this view (scan, click, camera poll) can trigger the flush
+    maybe_flush_pending_qrs(detail_worksheet)
+    
+    pending_here = [row[0] for row in pending_qrs if row[1] == folio]
+    
+    with summary:
+        # Only what the sheet has confirmed; buffered scans are counted apart
+        st.metric("Documentos Escaneados", count_scanned,
+                  delta=f"{len(pending_here)} en cola" if pending_here else None, delta_color="off")
+        if pending_qrs:
+            c_pend1, c_pend2 = st.columns([3, 1])
+            with c_pend1:
+                if st.session_state.get("qr_flush_job"):
+                    st.caption(f"Sincronizando {len(pending_qrs)} registros...")
+                else:
+                    st.caption(f"{len(pending_qrs)} pendientes de sincronizar")
+            with c_pend2:
+                if st.button("Sincronizar", key=f"flush_{folio}"):
+                    flush_pending_qrs(detail_worksheet)
+                    st.rerun(scope="fragment")
+    
     with col_list:
         st.subheader("Registros en este Folio")
+        for qr_val in pending_here:
+            st.text(f"⏳ {qr_val}")
         if not details_df.empty:
             # Filter specifically for this folio to avoid showing unrelated scans 
             # (though get_folio_details already does this, safety check)
             # Displaying QR_DATA only
             
-            # Simple table with delete button
-            for idx, row in details_df.iterrows():
-                qr_val = row.get('QR_DATA', 'Unknown')
-                c1, c2 = st.columns([4, 1])
-                with c1:
-                    st.text(f"📄 {qr_val}")
-                with c2:
-                    if st.button("🗑️", key=f"del_{qr_val}_{idx}"): # Unique key with index
-                        dtlm.delete_qr_scan(detail_worksheet, qr_val)
-                        st.rerun()
-        else:
+            # Single table; selected rows can be deleted in one action
+            qr_event = st.dataframe(
+                details_df[["QR_DATA"]],
+                key=f"details_table_{folio}",
+                on_select="rerun",
+                selection_mode="multi-row",
+                hide_index=True,
+                use_container_width=True
+            )
+            selected_qrs = details_df["QR_DATA"].iloc[qr_event.selection.rows].tolist()
+            if selected_qrs and st.button(f"🗑️ Eliminar seleccionados ({len(selected_qrs)})", key=f"del_sel_{folio}"):
+                success, msg = dtlm.delete_qr_scans(detail_worksheet, selected_qrs)
+                if not success:
+                    st.toast(msg, icon="⚠️")
+                invalidate_folio_details(folio)
+                st.rerun(scope="fragment")
+        elif not pending_here:
             st.info("Aún no hay documentos escaneados.")
 
 if __name__ == "__main__":
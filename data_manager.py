@@ -5,6 +5,10 @@ from datetime import datetime
 from google.oauth2.service_account import Credentials
 import time
 import random
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
 
 # Scope for Google Sheets API
 SCOPES = [
@@ -20,18 +24,43 @@ REQUIRED_COLUMNS = [
     "CUENTA FOLIOS", "FOLIOS SCALD", "ESTATUS FOLIOS SCALD"
 ]
 
+# Uploads are appended in batches of this many rows, with a short pause in between
+APPEND_BATCH_ROWS = 500
+APPEND_BATCH_PAUSE_S = 0.2
+
+# A lookup miss only rebuilds a folio index older than this, so a burst of unknown
+# folios (or one bad code scanned repeatedly) costs at most one column read
+FOLIO_INDEX_MIN_AGE_S = 10
+
+# Columns with a small vocabulary, loaded as pandas categoricals
+CATEGORICAL_COLUMNS = ["ESTATUS", "CAPTURISTA", "RUTA"]
+
+SPREADSHEET_NAME = "SISTEMA_PICKINGS_DB"
+
+USER_COLUMNS = ["USUARIO", "ROL", "FECHA_CREACION", "DELETED"]
+
+# Value of the DELETED column for soft-deleted rows (users and QR details)
+DELETED_FLAG = "1"
+
+@st.cache_resource # Parsing the private key is the costly part; reconnects reuse it
+def get_credentials():
+    """
+    Service account credentials from Streamlit secrets, or None if missing.
+    """
+    if "gcp_service_account" not in st.secrets:
+        return None
+    return Credentials.from_service_account_info(dict(st.secrets["gcp_service_account"]), scopes=SCOPES)
+
 @st.cache_resource
 def get_gspread_client():
     """
     Initializes and returns a gspread client using Streamlit secrets.
     """
     try:
-        if "gcp_service_account" not in st.secrets:
+        creds = get_credentials()
+        if creds is None:
             st.error("No credentials found in .streamlit/secrets.toml")
             return None
-            
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
         
         # Add retry with backoff for client authorization
         # Although client auth usually doesn't hit quota, operations do.
@@ -41,60 +70,164 @@ def get_gspread_client():
         st.error(f"Error connecting to Google Sheets: {e}")
         return None
 
-def with_retry(func, *args, **kwargs):
+# HTTP statuses worth retrying: quota (429) and transient server errors
+RETRYABLE_STATUS = {429, 500, 502, 503}
+# Appends aren't idempotent: a 5xx may come back after the rows were written, so only
+# a quota rejection (nothing applied) is retried
+APPEND_RETRYABLE_STATUS = {429}
+MAX_BACKOFF_S = 64
+
+class QuotaExceeded(Exception):
     """
-    Helper to retry API calls on 429 Quota Exceeded.
-    More aggressive backoff to solve persistent quota issues.
+    Raised by with_retry when a quota/transient error persists through every retry.
+    Sheet functions let it through their generic error handling so the app can show
+    a specific message (and so cached readers don't store the failure).
+    """
+
+class SheetsUnavailable(QuotaExceeded):
     """
-    max_retries = 4
+    Raised instead of QuotaExceeded when the retries ran out on 5xx errors (an outage,
+    not the quota). A subclass, so the handlers that let QuotaExceeded through pass it on too.
+    """
+
+def _status(e):
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _is_retryable(e, statuses=RETRYABLE_STATUS):
+    status = _status(e)
+    if status is not None:
+        return status in statuses
+    error_str = str(e)
+    return "429" in error_str or "Quota exceeded" in error_str or "RESOURCE_EXHAUSTED" in error_str
+
+def _retry_after(e):
+    """Seconds the server asked us to wait (Retry-After header), or None."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def with_retry(func, *args, retry_on=RETRYABLE_STATUS, **kwargs):
+    """
+    Helper to retry API calls on 429 Quota Exceeded and transient 5xx errors.
+    More aggressive backoff to solve persistent quota issues; honors Retry-After.
+    Pass retry_on=APPEND_RETRYABLE_STATUS for appends.
+    """
+    max_retries = 5
     for attempt in range(max_retries):
         try:
             return func(*args, **kwargs)
         except Exception as e:
-            error_str = str(e)
-            if "429" in error_str or "Quota exceeded" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                if attempt < max_retries - 1:
-                    # Exponential backoff with jitter: 2s, 6s, 14s... + random
-                    sleep_time = (2 ** (attempt + 1)) + 2 + random.uniform(0, 1)
-                    print(f"Quota hit. Retrying in {sleep_time:.2f}s...")
-                    time.sleep(sleep_time)
-                    continue
-            raise e
-
-@st.cache_resource(ttl=300) # Cache worksheet object for 5 mins to avoid re-opening constantly
+            if not _is_retryable(e, retry_on):
+                raise e
+            if attempt == max_retries - 1:
+                if _status(e) in (None, 429):
+                    raise QuotaExceeded(f"Google Sheets sigue saturado tras {max_retries} intentos: {e}") from e
+                raise SheetsUnavailable(f"Google Sheets no responde tras {max_retries} intentos: {e}") from e
+            # Exponential backoff with jitter: 4s, 6s, 10s, 18s... + random, capped
+            # Capped either way: writers wait here while holding _WRITE_LOCK
+            sleep_time = min(MAX_BACKOFF_S, _retry_after(e) or (2 ** (attempt + 1)) + 2 + random.uniform(0, 1))
+            print(f"Quota hit or transient API error. Retrying in {sleep_time:.2f}s...")
+            time.sleep(sleep_time)
+
+# Module-level, not cache_resource: it must be the same lock on the background writer thread
+_WRITE_LOCK = threading.Lock()
+
+def serialized_write(func):
+    """
+    Runs a sheet mutation under a process-wide lock, so concurrent sessions can't
+    interleave a read-modify-write (e.g. two receptions of the same folio).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _WRITE_LOCK:
+            return func(*args, **kwargs)
+    return wrapper
+
+@st.cache_resource
+def get_write_executor():
+    """
+    Background thread for Sheets writes, shared by the process.
+    A single worker keeps writes in submission order.
+    """
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets-writer")
+
+def submit_write(func, *args, **kwargs):
+    """
+    Runs a write function off the script thread and returns its Future.
+    The function must not call Streamlit APIs; callers poll the Future on a later rerun.
+    Only the QR scan flush goes through here. Interactive writes (status, reassignment,
+    reception, users, deletes) stay synchronous so their result is shown right away;
+    they share _WRITE_LOCK, so one can wait behind a flush that is being written.
+    """
+    return get_write_executor().submit(func, *args, **kwargs)
+
+@st.cache_resource # Spreadsheet handle is shared by all worksheet getters for the process
+def get_spreadsheet():
+    """
+    Opens the spreadsheet once so the worksheet getters don't each call client.open().
+    """
+    client = get_gspread_client()
+    if not client: return None
+    
+    try:
+        # Opening by key skips the Drive search by file name
+        if "spreadsheet_key" in st.secrets:
+            return with_retry(client.open_by_key, st.secrets["spreadsheet_key"])
+        return with_retry(client.open, SPREADSHEET_NAME)
+    except gspread.SpreadsheetNotFound:
+        service_email = client.auth.service_account_email
+        error_msg = (
+            f"No se encontró la hoja de cálculo '{SPREADSHEET_NAME}'.\n\n"
+            f"POR FAVOR:\n"
+            f"1. Crea una nueva Hoja de Cálculo en Google Sheets llamada '{SPREADSHEET_NAME}'.\n"
+            f"2. Compártela con permisos de EDITOR al siguiente email:\n"
+            f"   {service_email}"
+        )
+        st.error(error_msg)
+        return None
+    except Exception as e:
+        print(f"Error opening spreadsheet: {e}")
+        return None
+
+@st.cache_resource
+def get_worksheet_map():
+    """
+    Returns {title: Worksheet} from one metadata request, so opening the pickings, users
+    and detail sheets costs one round trip instead of one sh.worksheet() call each.
+    """
+    sh = get_spreadsheet()
+    if not sh: return {}
+    return {ws.title: ws for ws in with_retry(sh.worksheets)}
+
+def clear_sheet_handles():
+    """
+    Drops cached spreadsheet/worksheet handles so the next rerun reconnects.
+    Used when a getter returned None, since st.cache_resource would otherwise keep the failure.
+    """
+    get_gspread_client.clear()
+    get_spreadsheet.clear()
+    get_worksheet_map.clear()
+    get_or_create_worksheet.clear()
+    get_or_create_users_worksheet.clear()
+
+@st.cache_resource # Worksheet handles survive across reruns; gspread refreshes the token itself
 def get_or_create_worksheet():
     """
     Gets the worksheet or creates it if it doesn't exist (assuming the spreadsheet exists).
     Client created internally.
     """
-    client = get_gspread_client()
-    if not client: return None
+    sh = get_spreadsheet()
+    if not sh: return None
     
-    SPREADSHEET_NAME = "SISTEMA_PICKINGS_DB"
     sheet_name = "pickings"
     
     try:
-        try:
-            # We don't cache client.open because client object is already cached
-            # But we should retry the open call
-            sh = with_retry(client.open, SPREADSHEET_NAME)
-        except gspread.SpreadsheetNotFound:
-            service_email = client.auth.service_account_email
-            error_msg = (
-                f"No se encontró la hoja de cálculo '{SPREADSHEET_NAME}'.\n\n"
-                f"POR FAVOR:\n"
-                f"1. Crea una nueva Hoja de Cálculo en Google Sheets llamada '{SPREADSHEET_NAME}'.\n"
-                f"2. Compártela con permisos de EDITOR al siguiente email:\n"
-                f"   {service_email}"
-            )
-            st.error(error_msg)
-            return None
-        
-        try:
-            worksheet = with_retry(sh.worksheet, sheet_name)
-        except gspread.WorksheetNotFound:
+        worksheet = get_worksheet_map().get(sheet_name)
+        if worksheet is None:
             worksheet = with_retry(sh.add_worksheet, title=sheet_name, rows=1000, cols=20)
-            worksheet.append_row(REQUIRED_COLUMNS)
+            with_retry(worksheet.append_row, REQUIRED_COLUMNS, retry_on=APPEND_RETRYABLE_STATUS)
             
         return worksheet
     except Exception as e:
@@ -103,29 +236,202 @@ def get_or_create_worksheet():
         print(f"Error accessing worksheet: {e}")
         return None
 
+@functools.lru_cache(maxsize=None)
+def column_letter(col):
+    """A1 column letter for a 1-based column index (computed once per index)."""
+    return gspread.utils.rowcol_to_a1(1, col).rstrip("0123456789")
+
+def pack_row_updates(row_idx, values_by_col):
+    """
+    batch_update payload for one row: adjacent columns share a single range
+    (e.g. ESTATUS + FECHA_ULTIMO_EVENTO) instead of one range per cell.
+    """
+    runs = []  # [first_col, [values...]]
+    for col in sorted(values_by_col):
+        if runs and col == runs[-1][0] + len(runs[-1][1]):
+            runs[-1][1].append(values_by_col[col])
+        else:
+            runs.append([col, [values_by_col[col]]])
+    return [
+        {"range": f"{column_letter(first)}{row_idx}:{column_letter(first + len(vals) - 1)}{row_idx}", "values": [vals]}
+        for first, vals in runs
+    ]
+
+def tombstone_rows(worksheet, rows, headers=None):
+    """
+    Soft-deletes rows by flagging their DELETED cell: one values write and no rows shifted,
+    unlike delete_rows. The column is found by header name (row 1 is read if headers isn't
+    given); a sheet created before the column existed gets it after its last header.
+    """
+    if headers is None:
+        headers = with_retry(worksheet.row_values, 1)
+    updates = []
+    if "DELETED" in headers:
+        deleted_col = headers.index("DELETED") + 1
+    else:
+        deleted_col = len(headers) + 1
+        if deleted_col > worksheet.col_count:
+            with_retry(worksheet.add_cols, deleted_col - worksheet.col_count)
+        updates.append({"range": f"{column_letter(deleted_col)}1", "values": [["DELETED"]]})
+    letter = column_letter(deleted_col)
+    updates += [{"range": f"{letter}{r}", "values": [[DELETED_FLAG]]} for r in rows]
+    with_retry(worksheet.batch_update, updates)
+
+@serialized_write
+def purge_deleted_rows(worksheet):
+    """
+    Physically removes soft-deleted rows in one batch request. Rows below move up; that
+    is safe at any time because the row-addressed writers of these sheets (delete_user,
+    delete_qr_scans) re-read their rows under the same write lock.
+    """
+    try:
+        headers = with_retry(worksheet.row_values, 1)
+        if "DELETED" not in headers:
+            return True, "No hay registros eliminados."
+        flags = with_retry(worksheet.col_values, headers.index("DELETED") + 1)
+        rows = [i for i, v in enumerate(flags, start=1) if i > 1 and v == DELETED_FLAG]
+        if not rows:
+            return True, "No hay registros eliminados."
+        
+        # Bottom-up so earlier deletions don't shift the rows still to delete
+        requests = [
+            {"deleteDimension": {"range": {
+                "sheetId": worksheet.id, "dimension": "ROWS",
+                "startIndex": r - 1, "endIndex": r,
+            }}}
+            for r in sorted(rows, reverse=True)
+        ]
+        # A 5xx may come back after the rows were removed; repeating it would delete the rows
+        # that moved up, so only a quota rejection (nothing applied) is retried
+        with_retry(worksheet.spreadsheet.batch_update, {"requests": requests}, retry_on=APPEND_RETRYABLE_STATUS)
+        return True, f"{len(rows)} registros depurados."
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        return False, f"Error depurando registros: {e}"
+
+def _load_columns(worksheet, columns):
+    """
+    Fetches only the given columns with a single batch_get.
+    Values are kept as the sheet's strings, like the full load.
+    """
+    headers = with_retry(worksheet.row_values, 1)
+    present = [c for c in columns if c in headers]
+    if not present:
+        return pd.DataFrame()
+    
+    ranges = []
+    for col in present:
+        letter = column_letter(headers.index(col) + 1)
+        ranges.append(f"{letter}2:{letter}")
+    value_ranges = with_retry(worksheet.batch_get, ranges, major_dimension="COLUMNS")
+    
+    # Sheets trims trailing blanks, so columns can come back with different lengths
+    values = [vr[0] if vr else [] for vr in value_ranges]
+    n_rows = max(len(v) for v in values)
+    return pd.DataFrame({
+        col: v + [""] * (n_rows - len(v)) for col, v in zip(present, values)
+    })
+
+def _normalize_frame(df, expected):
+    """
+    Adds missing columns and applies the dtypes the views rely on (also for empty frames).
+    """
+    # Ensure all required columns exist
+    for col in expected:
+        if col not in df.columns:
+            df[col] = ""
+    # Folios are compared as strings everywhere; convert once here instead of per filter/search.
+    # Arrow-backed strings (pyarrow ships with Streamlit) run str.contains in compiled code
+    df["FOLIO"] = df["FOLIO"].astype(str).astype("string[pyarrow]")
+    # Low-cardinality columns: categorical codes make isin/== and serialization cheaper
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(str).astype("category")
+    # Remaining text columns as Arrow strings: contiguous buffers instead of one Python object per cell
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].astype(str).astype("string[pyarrow]")
+    # Counter column: blanks become 0 so consumers don't need per-row checks
+    if "# FOLIOS DOCUMENTOS" in df.columns:
+        df["# FOLIOS DOCUMENTOS"] = pd.to_numeric(df["# FOLIOS DOCUMENTOS"], errors="coerce").fillna(0).astype("int32")
+    return df
+
 @st.cache_data(ttl=300) 
-def load_data(_worksheet):
+def load_data(_worksheet, columns=None):
     """
     Reads data from the worksheet and returns a DataFrame.
+    If columns is given, only those columns are downloaded.
     """
+    expected = list(columns) if columns else REQUIRED_COLUMNS
     try:
-        # Use with_retry for get_all_records
-        data = with_retry(_worksheet.get_all_records)
-        if not data:
-            return pd.DataFrame(columns=REQUIRED_COLUMNS)
-        df = pd.DataFrame(data)
-        # Ensure all required columns exist
-        for col in REQUIRED_COLUMNS:
-            if col not in df.columns:
-                df[col] = ""
-        return df
+        if columns:
+            df = _load_columns(_worksheet, columns)
+        else:
+            # Rows as lists straight into the frame: no per-row dict, and values stay as
+            # the sheet shows them (folios like "00123" keep their zeros)
+            data = with_retry(_worksheet.get_all_values)
+            df = pd.DataFrame(data[1:], columns=data[0]) if data else pd.DataFrame()
+        if df.empty:
+            df = pd.DataFrame(columns=expected)
+        return _normalize_frame(df, expected)
+    except QuotaExceeded:
+        raise
     except Exception as e:
         # Suppress the red error banner for quota issues
         # Return empty DF to allow UI to render partially or retry later
         print(f"Error reading data (likely quota): {e}")
         st.warning("El sistema está saturado. Reintentando en unos segundos...")
         time.sleep(2)
-        return pd.DataFrame(columns=REQUIRED_COLUMNS)
+        return _normalize_frame(pd.DataFrame(columns=expected), expected)
+
+@st.cache_data(ttl=300)
+def load_data_for_user(_worksheet, user, columns=None):
+    """
+    Rows assigned to one capturista, filtered from the column-pruned load_data frame.
+    That single read is shared by every capturista, and its size doesn't grow with
+    how scattered the user's rows are.
+    """
+    if columns and "CAPTURISTA" not in columns:
+        columns = tuple(columns) + ("CAPTURISTA",)
+    df = load_data(_worksheet, tuple(columns) if columns else None)
+    return df[df["CAPTURISTA"] == user].reset_index(drop=True)
+
+@st.cache_data(ttl=300)
+def get_folio_options(_worksheet):
+    """
+    Unique folios for selectboxes and lookups, computed once per data load instead of on every rerun.
+    Taken from the full load the operations tab already makes, so it costs no extra sheet read.
+    """
+    return load_data(_worksheet)["FOLIO"].unique().tolist()
+
+@st.cache_resource(ttl=300) # A shared set (not a copy per call), so the reception check is O(1) without rebuilding it
+def get_folio_set(_worksheet):
+    """
+    Set of get_folio_options, for membership checks.
+    """
+    return frozenset(get_folio_options(_worksheet))
+
+@st.cache_data(ttl=300)
+def get_kpis(_worksheet):
+    """
+    Dashboard aggregates: counts per status and a capturista x status table.
+    Cached with the data so dashboard reruns don't regroup the whole sheet.
+    """
+    df = load_data(_worksheet)
+    status_counts = df["ESTATUS"].value_counts()
+    capturista_counts = pd.crosstab(df["CAPTURISTA"], df["ESTATUS"])
+    return status_counts, capturista_counts
+
+def clear_data_cache():
+    """
+    Invalidates the master data and everything derived from it. Call after any write.
+    """
+    load_data.clear()
+    load_data_for_user.clear()
+    get_folio_options.clear()
+    get_folio_set.clear()
+    get_kpis.clear()
 
 def sync_excel_data(worksheet, uploaded_file):
     """
@@ -133,10 +439,20 @@ def sync_excel_data(worksheet, uploaded_file):
     1. Validate columns
     2. Extract unique folios (check against existing)
     3. Append new records
+    Parsing runs outside _WRITE_LOCK; only the dedupe against the sheet and the append hold it.
     """
     try:
-        # Read uploaded Excel
-        new_df = pd.read_excel(uploaded_file)
+        # Read uploaded Excel with the Rust-based calamine parser (also reads .xls).
+        # Only the sheet's columns are parsed, as text: every value is written back as a string
+        read_opts = {
+            "dtype": str,
+            "usecols": lambda c: str(c).upper().strip() in REQUIRED_COLUMNS,
+        }
+        try:
+            new_df = pd.read_excel(uploaded_file, engine="calamine", **read_opts)
+        except ImportError:
+            uploaded_file.seek(0)
+            new_df = pd.read_excel(uploaded_file, **read_opts)
         
         # Standardize columns to uppercase
         new_df.columns = [str(c).upper().strip() for c in new_df.columns]
@@ -145,140 +461,190 @@ def sync_excel_data(worksheet, uploaded_file):
         missing_cols = [c for c in ["FOLIO"] if c not in new_df.columns] # Minimal requirement is FOLIO
         if missing_cols:
             return False, f"Missing required columns in Excel: {missing_cols}"
-            
-        # Get existing data
-        existing_records = worksheet.get_all_records()
-        existing_df = pd.DataFrame(existing_records)
         
-        existing_folios = set()
-        if not existing_df.empty and "FOLIO" in existing_df.columns:
-             existing_folios = set(existing_df["FOLIO"].astype(str).str.strip())
+        # Normalize the file before taking the lock: only the dedupe needs the sheet
+        new_df = new_df.fillna("")
+        folios = new_df["FOLIO"].astype(str).str.strip()
+        # Rows with a folio, first occurrence within the file
+        candidates = (folios != "") & ~folios.duplicated()
         
-        records_to_add = []
-        added_count = 0
-        duplicates_count = 0
+        # Prepare records. Cells were parsed as text and blanks filled, so they are already
+        # strings; sent RAW so folios like "00123" keep their leading zeros
+        to_add = new_df.loc[candidates].reindex(columns=REQUIRED_COLUMNS, fill_value="")
+        to_add["FOLIO"] = folios[candidates]
+        # Defaults
+        to_add["ESTATUS"] = to_add["ESTATUS"].mask(to_add["ESTATUS"] == "", "PENDIENTE") # Initial status
+        to_add["FECHA_ULTIMO_EVENTO"] = to_add["FECHA_ULTIMO_EVENTO"].mask(
+            to_add["FECHA_ULTIMO_EVENTO"] == "", datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        )
         
-        for _, row in new_df.iterrows():
-            folio = str(row.get("FOLIO", "")).strip()
-            if not folio or folio in existing_folios:
-                duplicates_count += 1
-                continue
-            
-            # Prepare record
-            record = {}
-            for col in REQUIRED_COLUMNS:
-                val = row.get(col, "")
-                # Defaults
-                if col == "ESTATUS" and not val:
-                    val = "PENDIENTE" # Initial status
-                if col == "FECHA_ULTIMO_EVENTO" and not val:
-                    val = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                record[col] = str(val) # Convert to string for Sheets
+        with _WRITE_LOCK:
+            # Existing folios: only the FOLIO column is needed, not the whole sheet.
+            # Read it fresh (another upload may have just landed); this also refreshes the row index
+            get_folio_rows.clear()
+            _, folio_rows, _ = get_folio_rows(worksheet)
+            # Arrow-backed Index: contiguous storage, and isin probes a hashtable without Python-level set building
+            existing_folios = pd.Index(list(folio_rows), dtype="string[pyarrow]").str.strip()
             
-            records_to_add.append([record[c] for c in REQUIRED_COLUMNS])
-            existing_folios.add(folio)
-            added_count += 1
-            
-        if records_to_add:
-            worksheet.append_rows(records_to_add)
-            return True, f"Successfully added {added_count} new records. Skipped {duplicates_count} duplicates."
-        else:
-            return True, "No new records to add (all duplicates)."
+            # Keep rows whose folio is not in the sheet yet
+            records_to_add = to_add.loc[~to_add["FOLIO"].isin(existing_folios)].values.tolist()
+            added_count = len(records_to_add)
+            duplicates_count = len(new_df) - added_count
+                
+            if records_to_add:
+                # Bounded batches: large single appends hit the cell limit and drain the per-minute quota
+                for start in range(0, added_count, APPEND_BATCH_ROWS):
+                    try:
+                        with_retry(worksheet.append_rows, records_to_add[start:start + APPEND_BATCH_ROWS],
+                                   retry_on=APPEND_RETRYABLE_STATUS)
+                    except QuotaExceeded:
+                        raise
+                    except Exception as e:
+                        get_folio_rows.clear()
+                        return False, f"Error processing file after {start} of {added_count} new records: {e}"
+                    if start + APPEND_BATCH_ROWS < added_count:
+                        time.sleep(APPEND_BATCH_PAUSE_S)
+                get_folio_rows.clear()
+                return True, f"Successfully added {added_count} new records. Skipped {duplicates_count} duplicates."
+            else:
+                return True, "No new records to add (all duplicates)."
             
+    except QuotaExceeded:
+        raise
     except Exception as e:
         return False, f"Error processing file: {e}"
 
-def update_status(worksheet, folio, new_status, user_name):
+@st.cache_resource(ttl=300) # One shared index (not a copy per lookup); callers must not modify it
+def get_folio_rows(_worksheet):
     """
-    Updates the status of a specific picking.
+    Returns (headers, {folio: sheet row}, build time) from two small reads, so writes
+    locate their row with a dict lookup instead of a find() over the whole sheet.
+    Rows only move when the sheet is edited by hand; clear this cache then.
+    Cached process-wide, not per worksheet (_worksheet isn't hashed): only the
+    master sheet is passed here.
+    """
+    headers = with_retry(_worksheet.row_values, 1)
+    rows = {}
+    if "FOLIO" in headers:
+        values = with_retry(_worksheet.col_values, headers.index("FOLIO") + 1)
+        # First occurrence wins, as with find()
+        for i, value in enumerate(values[1:], start=2):
+            rows.setdefault(str(value), i)
+    return headers, rows, time.monotonic()
+
+def locate_folios(worksheet, folios):
+    """
+    Returns (headers, {folio: row}) for several folios; row is None if a folio isn't in the sheet.
+    """
+    headers, rows, built_at = get_folio_rows(worksheet)
+    if (any(str(f) not in rows for f in folios)
+            and time.monotonic() - built_at > FOLIO_INDEX_MIN_AGE_S):
+        # Unknown folios may have been appended since the index was built: rebuild it once
+        # for all of them (one column read, where find() would download the whole sheet)
+        get_folio_rows.clear()
+        headers, rows, _ = get_folio_rows(worksheet)
+    return headers, {f: rows.get(str(f)) for f in folios}
+
+def locate_folio(worksheet, folio):
+    """
+    Returns (headers, row) for a folio; row is None if it isn't in the sheet.
+    """
+    headers, found = locate_folios(worksheet, [folio])
+    return headers, found[folio]
+
+@serialized_write
+def update_status_bulk(worksheet, statuses, user_name):
+    """
+    Updates several pickings at once. statuses maps folio -> new status.
+    Rows are located through the cached folio index and written with a single batch_update.
     """
     try:
-        # We need to find the row index. 
-        # For performance in large sheets, batch reading is better, but cell-finding is safer for concurrency if low volume.
-        # Here we assume reasonable volume.
-        cell = worksheet.find(folio)
-        if not cell:
-            return False, "Folio not found"
-            
-        row_idx = cell.row
-        
-        # Column indices (1-based)
-        headers = worksheet.row_values(1)
+        headers, rows = locate_folios(worksheet, list(statuses))
         try:
             status_col = headers.index("ESTATUS") + 1
             event_col = headers.index("EVENTO") + 1
             date_col = headers.index("FECHA_ULTIMO_EVENTO") + 1
         except ValueError:
+            get_folio_rows.clear() # Headers are cached; re-read them on the next attempt
             return False, "Column headers mismatch"
-            
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        # Batch update
-        updates = [
-            {"range": gspread.utils.rowcol_to_a1(row_idx, status_col), "values": [[new_status]]},
-            {"range": gspread.utils.rowcol_to_a1(row_idx, event_col), "values": [[f"Status changed to {new_status} by {user_name}"]]},
-            {"range": gspread.utils.rowcol_to_a1(row_idx, date_col), "values": [[timestamp]]}
-        ]
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        updates, missing = [], []
+        for folio, new_status in statuses.items():
+            row_idx = rows[folio]
+            if row_idx is None:
+                missing.append(str(folio))
+                continue
+            updates += pack_row_updates(row_idx, {
+                status_col: new_status,
+                event_col: f"Status changed to {new_status} by {user_name}",
+                date_col: timestamp,
+            })
         
-        worksheet.batch_update(updates)
+        if updates:
+            with_retry(worksheet.batch_update, updates)
+        if missing:
+            return False, f"Folios not found: {', '.join(missing)}"
         return True, "Status updated successfully"
         
+    except QuotaExceeded:
+        raise
     except Exception as e:
         return False, f"Update failed: {e}"
 
+@serialized_write
 def reassign_capturista(worksheet, folio, new_capturista, user_name):
     """
     Updates the CAPTURISTA of a specific picking.
     """
     try:
-        cell = worksheet.find(folio)
-        if not cell:
+        headers, row_idx = locate_folio(worksheet, folio)
+        if not row_idx:
             return False, "Folio not found"
             
-        row_idx = cell.row
-        headers = worksheet.row_values(1)
         try:
             capturista_col = headers.index("CAPTURISTA") + 1
             event_col = headers.index("EVENTO") + 1
             date_col = headers.index("FECHA_ULTIMO_EVENTO") + 1
         except ValueError:
+            get_folio_rows.clear() # Headers are cached; re-read them on the next attempt
             return False, "Column headers mismatch"
             
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        updates = [
-            {"range": gspread.utils.rowcol_to_a1(row_idx, capturista_col), "values": [[new_capturista]]},
-            {"range": gspread.utils.rowcol_to_a1(row_idx, event_col), "values": [[f"Reassigned to {new_capturista} by {user_name}"]]},
-            {"range": gspread.utils.rowcol_to_a1(row_idx, date_col), "values": [[timestamp]]}
-        ]
+        updates = pack_row_updates(row_idx, {
+            capturista_col: new_capturista,
+            event_col: f"Reassigned to {new_capturista} by {user_name}",
+            date_col: timestamp,
+        })
         
-        worksheet.batch_update(updates)
+        with_retry(worksheet.batch_update, updates)
         return True, "Capturista updated successfully"
         
+    except QuotaExceeded:
+        raise
     except Exception as e:
         return False, f"Update failed: {e}"
 
-@st.cache_resource(ttl=300)
+@st.cache_resource
 def get_or_create_users_worksheet():
     """
     Gets or creates the 'usuarios' worksheet.
     Client is created internally to avoid hashing issues.
     """
-    client = get_gspread_client()
-    if not client: return None
+    sh = get_spreadsheet()
+    if not sh: return None
     
     sheet_name = "usuarios"
-    SPREADSHEET_NAME = "SISTEMA_PICKINGS_DB"
     try:
-        sh = with_retry(client.open, SPREADSHEET_NAME)
-        try:
-            worksheet = with_retry(sh.worksheet, sheet_name)
-        except gspread.WorksheetNotFound:
+        worksheet = get_worksheet_map().get(sheet_name)
+        if worksheet is None:
             worksheet = with_retry(sh.add_worksheet, title=sheet_name, rows=100, cols=5)
             # Default headers
-            worksheet.append_row(["USUARIO", "ROL", "FECHA_CREACION"])
+            with_retry(worksheet.append_row, USER_COLUMNS, retry_on=APPEND_RETRYABLE_STATUS)
             # Default Admin user
-            worksheet.append_row(["Admin", "RESPONSABLE", datetime.now().strftime("%Y-%m-%d")])
+            with_retry(worksheet.append_row, ["Admin", "RESPONSABLE", datetime.now().strftime("%Y-%m-%d")],
+                       retry_on=APPEND_RETRYABLE_STATUS)
         return worksheet
     except Exception as e:
         print(f"Error accessing users worksheet: {e}")
@@ -288,32 +654,67 @@ def get_or_create_users_worksheet():
 def get_all_users(_worksheet):
     """
     Returns a list of dictionaries with user info.
+    Read errors propagate (so a failure isn't cached); callers handle them.
     """
-    try:
-        records = with_retry(_worksheet.get_all_records)
-        if not records:
-             return [{"USUARIO": "Admin", "ROL": "RESPONSABLE"}]
-        return records
-    except Exception as e:
-        st.error(f"Error reading users: {e}")
-        return []
+    # Plain strings: get_all_records would try to parse every cell as a number
+    rows = with_retry(_worksheet.get_all_values)
+    records = [dict(zip(rows[0], r)) for r in rows[1:]] if rows else []
+    records = [r for r in records if r.get("DELETED", "") != DELETED_FLAG]
+    if not records:
+         return [{"USUARIO": "Admin", "ROL": "RESPONSABLE"}]
+    return records
 
+@st.cache_data(ttl=300)
+def get_users_index(_worksheet):
+    """
+    Returns (by_name, by_role) lookups over get_all_users, built once per cache period.
+    """
+    by_name, by_role = {}, defaultdict(list)
+    for u in get_all_users(_worksheet):
+        by_name[u["USUARIO"]] = u
+        by_role[u["ROL"]].append(u["USUARIO"])
+    return by_name, dict(by_role)
+
+def clear_users_cache():
+    """Call after any users sheet write."""
+    get_all_users.clear()
+    get_users_index.clear()
+
+def _active_user_rows(worksheet):
+    """
+    (headers, {USUARIO: sheet row}) for users not soft-deleted, from a fresh read of the sheet.
+    """
+    values = with_retry(worksheet.get_all_values)
+    headers = values[0] if values else []
+    name_idx = headers.index("USUARIO") if "USUARIO" in headers else 0
+    deleted_idx = headers.index("DELETED") if "DELETED" in headers else None
+    rows = {}
+    for i, row in enumerate(values[1:], start=2):
+        if deleted_idx is not None and deleted_idx < len(row) and row[deleted_idx] == DELETED_FLAG:
+            continue
+        if name_idx < len(row) and row[name_idx]:
+            rows.setdefault(row[name_idx], i)
+    return headers, rows
+
+@serialized_write
 def add_user(worksheet, name, role):
     """
     Adds a new user to the system.
     """
     try:
-        # Simple check if user exists by name
-        cell = worksheet.find(name)
-        if cell:
+        # Deleted users don't count, so a name can be created again
+        if name in _active_user_rows(worksheet)[1]:
             return False, "El usuario ya existe."
         
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        worksheet.append_row([name, role, timestamp])
+        with_retry(worksheet.append_row, [name, role, timestamp], retry_on=APPEND_RETRYABLE_STATUS)
         return True, "Usuario creado exitosamente."
+    except QuotaExceeded:
+        raise
     except Exception as e:
         return False, f"Error creando usuario: {e}"
 
+@serialized_write
 def delete_user(worksheet, name):
     """
     Deletes a user.
@@ -322,38 +723,46 @@ def delete_user(worksheet, name):
         if name == "Admin":
             return False, "No se puede eliminar al usuario Admin."
             
-        cell = worksheet.find(name)
-        if not cell:
+        headers, active = _active_user_rows(worksheet)
+        row_idx = active.get(name)
+        if not row_idx:
             return False, "Usuario no encontrado."
             
-        worksheet.delete_rows(cell.row)
+        tombstone_rows(worksheet, [row_idx], headers)
         return True, "Usuario eliminado correctamente."
+    except QuotaExceeded:
+        raise
     except Exception as e:
         return False, f"Error eliminando usuario: {e}"
 
+@serialized_write
 def increment_folio_count(worksheet, folio, scanned_qr):
     """
     Adds a scanned QR to 'FOLIO DOCUMENTOS POR PICKING' and increments '# FOLIOS DOCUMENTOS'.
     This is for the Warehouse Reception scanning.
     """
     try:
-        cell = worksheet.find(folio)
-        if not cell:
+        headers, row_idx = locate_folio(worksheet, folio)
+        if not row_idx:
             return False, "Folio padre no encontrado en base maestra."
         
-        row_idx = cell.row
-        headers = worksheet.row_values(1)
-        
         try:
             docs_col = headers.index("FOLIO DOCUMENTOS POR PICKING") + 1
             count_col = headers.index("# FOLIOS DOCUMENTOS") + 1
             status_col = headers.index("ESTATUS") + 1
         except ValueError:
+            get_folio_rows.clear() # Headers are cached; re-read them on the next attempt
             return False, "Columnas requeridas no encontradas en la hoja."
 
-        # Get current values
-        current_docs = worksheet.cell(row_idx, docs_col).value or ""
-        current_count = worksheet.cell(row_idx, count_col).value
+        # Get current values: one read of the row instead of a cell() call per column
+        row = with_retry(worksheet.row_values, row_idx)
+        row += [""] * (len(headers) - len(row))
+        if "FOLIO" in headers and str(row[headers.index("FOLIO")]).strip() != str(folio):
+            # The sheet was edited by hand since the row index was built
+            get_folio_rows.clear()
+            return False, "La hoja cambió; vuelve a escanear."
+        current_docs = row[docs_col - 1] or ""
+        current_count = row[count_col - 1]
         
         # Safe integer conversion
         try:
@@ -361,8 +770,9 @@ def increment_folio_count(worksheet, folio, scanned_qr):
         except:
             current_count = 0
 
-        # Check duplicates in the string
-        if scanned_qr in current_docs:
+        # Check duplicates against the stored list (exact entries: "Q1" must not match "Q10").
+        # The cell caps at 50k characters; a per-document sheet would lift that limit
+        if scanned_qr in set(current_docs.split("\n")):
             return False, "Este documento ya fue escaneado para este folio."
 
         # Append new QR
@@ -374,25 +784,28 @@ def increment_folio_count(worksheet, folio, scanned_qr):
         new_count = current_count + 1
         
         # Batch update
-        updates = [
-            {"range": gspread.utils.rowcol_to_a1(row_idx, docs_col), "values": [[new_docs]]},
-            {"range": gspread.utils.rowcol_to_a1(row_idx, count_col), "values": [[new_count]]},
+        new_values = {
+            docs_col: new_docs,
+            count_col: new_count,
             # Default status to IMPRESOS on first scan if empty
             # But prompt says: "al ser escaneados la primera vez debera estar en estatus impresos"
             # We can force it or check current status. Let's force it if it's PENDIENTE or empty.
-        ]
+        }
         
         # Check current status to decide if update needed
-        current_status = worksheet.cell(row_idx, status_col).value
+        current_status = row[status_col - 1]
         if not current_status or current_status == "PENDIENTE":
-             updates.append({"range": gspread.utils.rowcol_to_a1(row_idx, status_col), "values": [["IMPRESOS"]]})
+             new_values[status_col] = "IMPRESOS"
         
-        worksheet.batch_update(updates)
+        with_retry(worksheet.batch_update, pack_row_updates(row_idx, new_values))
         return True, f"Agregado correctamente. Conteo actual: {new_count}"
 
+    except QuotaExceeded:
+        raise
     except Exception as e:
         return False, f"Error en incremento: {e}"
 
+@serialized_write
 def update_parent_status_based_on_children(worksheet, folio, child_status="SURTIDO"):
     """
     Updates the parent folio status logic.
@@ -409,16 +822,14 @@ def update_parent_status_based_on_children(worksheet, folio, child_status="SURTI
     This function specifically updates the parent status column.
     """
     try:
-        cell = worksheet.find(folio)
-        if not cell: return False
+        headers, row_idx = locate_folio(worksheet, folio)
+        if not row_idx: return False
         
-        row_idx = cell.row
-        headers = worksheet.row_values(1)
         status_col = headers.index("ESTATUS") + 1
         
         # We just update it. The logic of *what* status to set is decided by the caller (UI)
         # based on what action was taken.
-        worksheet.update_cell(row_idx, status_col, child_status)
+        with_retry(worksheet.update_cell, row_idx, status_col, child_status)
         return True
     except:
         return False
@@ -1,5 +1,4 @@
 import pandas as pd
-import gspread
 from datetime import datetime
 import streamlit as st
 import data_manager as dm  # Import shared utilities
@@ -7,27 +6,24 @@ import data_manager as dm  # Import shared utilities
 # Define columns for the new 'detalle_pickings' sheet
 DETAIL_COLUMNS = [
     "QR_DATA", "FOLIO_PADRE", "CAPTURISTA", 
-    "ESTATUS_ITEM", "FECHA_ESCANEO", "DETALLES_EXTRA"
+    "ESTATUS_ITEM", "FECHA_ESCANEO", "DETALLES_EXTRA", "DELETED"
 ]
 
-@st.cache_resource(ttl=300)
+@st.cache_resource
 def get_or_create_detail_worksheet():
     """
     Gets or creates the detail worksheet for individual QR tracking.
     Client created internally.
     """
-    client = dm.get_gspread_client()
-    if not client: return None
+    sh = dm.get_spreadsheet()
+    if not sh: return None
     
     sheet_name = "detalle_pickings"
-    SPREADSHEET_NAME = "SISTEMA_PICKINGS_DB"
     try:
-        sh = dm.with_retry(client.open, SPREADSHEET_NAME)
-        try:
-            worksheet = dm.with_retry(sh.worksheet, sheet_name)
-        except gspread.WorksheetNotFound:
+        worksheet = dm.get_worksheet_map().get(sheet_name)
+        if worksheet is None:
             worksheet = dm.with_retry(sh.add_worksheet, title=sheet_name, rows=5000, cols=10)
-            worksheet.append_row(DETAIL_COLUMNS)
+            dm.with_retry(worksheet.append_row, DETAIL_COLUMNS, retry_on=dm.APPEND_RETRYABLE_STATUS)
         return worksheet
     except Exception as e:
         print(f"Error accessing detail worksheet: {e}")
@@ -41,9 +37,9 @@ def parse_qr_code(qr_string):
     if not qr_string: return None, None
     
     # Heuristic: If QR contains "|", assume format "FOLIO|DATA"
-    if "|" in qr_string:
-        parts = qr_string.split("|")
-        return parts[0].strip(), qr_string
+    folio, sep, _ = qr_string.partition("|")
+    if sep:
+        return folio.strip(), qr_string
         
     # If QR is just a long string, we might not be able to extract Folio easily
     # unless we match it against known folios. 
@@ -51,125 +47,157 @@ def parse_qr_code(qr_string):
     # but the calling function should override this if the context is known (e.g. inside a Folio view).
     return qr_string.strip(), "Raw QR"
 
-def register_qr_scan(detail_ws, qr_data, capturista, status="SURTIDO", forced_folio=None):
+def build_qr_row(qr_data, capturista, status="SURTIDO", forced_folio=None):
     """
-    Registers a scanned QR code.
+    Builds the detail sheet row for a scanned QR, or None if no folio can be determined.
     If forced_folio is provided, it associates the QR with that folio regardless of QR content.
     """
-    try:
-        # 1. Check duplicates
-        # For performance, we might want to cache existing QRs, but for now we search.
-        try:
-            cell = detail_ws.find(qr_data)
-            if cell:
-                return False, f"Este QR ya fue registrado previamente (Fila {cell.row})."
-        except gspread.exceptions.CellNotFound:
-            pass # Safe to proceed
-
-        # 2. Parse or Force Folio
-        if forced_folio:
-            folio = forced_folio
-            extra = qr_data # The QR is the detail itself
-        else:
-            folio, extra = parse_qr_code(qr_data)
-            
-        if not folio:
-            return False, "Formato de QR inválido o no legible."
-
-        # 3. Save
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        new_row = [
-            qr_data, folio, capturista, 
-            status, timestamp, extra
-        ]
-        detail_ws.append_row(new_row)
-        return True, f"QR registrado exitosamente. Folio vinculado: {folio}"
+    if forced_folio:
+        folio = forced_folio
+        extra = qr_data # The QR is the detail itself
+    else:
+        folio, extra = parse_qr_code(qr_data)
+        
+    if not folio:
+        return None
 
-    except Exception as e:
-        return False, f"Error registrando QR: {e}"
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        qr_data, folio, capturista, 
+        status, timestamp, extra
+    ]
+
+def _read_header_map(detail_ws):
+    """
+    Returns {header: 1-based column} of the detail sheet, read now (no Streamlit cache).
+    """
+    return {h: i + 1 for i, h in enumerate(dm.with_retry(detail_ws.row_values, 1))}
+
+@st.cache_data(ttl=300) # Headers don't change during a session
+def get_detail_header_map(_detail_ws):
+    """
+    Returns {header: 1-based column} of the detail sheet.
+    """
+    return _read_header_map(_detail_ws)
+
+def _live_qr_rows(detail_ws, cols=None):
+    """
+    [(sheet row, QR_DATA)] for records not soft-deleted: the QR and DELETED columns
+    (located by header) in one batch_get. cols defaults to the cached header map.
+    """
+    if cols is None:
+        cols = get_detail_header_map(detail_ws)
+    qr_letter = dm.column_letter(cols.get("QR_DATA", 1))
+    ranges = [f"{qr_letter}2:{qr_letter}"]
+    if "DELETED" in cols:
+        deleted_letter = dm.column_letter(cols["DELETED"])
+        ranges.append(f"{deleted_letter}2:{deleted_letter}")
+    value_ranges = dm.with_retry(detail_ws.batch_get, ranges)
+    qrs, flags = value_ranges[0], (value_ranges[1] if len(value_ranges) > 1 else [])
+    deleted = {i for i, v in enumerate(flags, start=2) if v and v[0] == dm.DELETED_FLAG}
+    return [(i, v[0]) for i, v in enumerate(qrs, start=2) if v and i not in deleted]
+
+@st.cache_resource(ttl=60) # A shared set (not a copy per call), so probing it per scan is O(1)
+def get_registered_qrs(_detail_ws):
+    """
+    Set of every QR already in the detail sheet, across all folios.
+    Read errors propagate: st.cache_resource would otherwise keep an empty set for a minute.
+    """
+    return frozenset(qr for _, qr in _live_qr_rows(_detail_ws))
 
-def update_qr_status(detail_ws, qr_data, new_status):
+@dm.serialized_write
+def register_qr_scans(detail_ws, rows):
     """
-    Updates the status of an existing QR (e.g., upon return from warehouse).
+    Saves several rows built by build_qr_row with a single append_rows call.
+    QRs already present in the sheet are skipped (one column read instead of a find per QR).
     """
     try:
-        cell = detail_ws.find(qr_data)
-        if not cell:
-            return False, "QR no encontrado en el sistema. ¿Fue registrado al inicio?"
+        # Runs on the background writer, where st.cache_* functions can't be used: read the headers directly
+        existing = {qr for _, qr in _live_qr_rows(detail_ws, _read_header_map(detail_ws))}
+        new_rows = []
+        for r in rows:
+            # Also drops repeats within the batch (same QR buffered under two folios)
+            if r[0] not in existing:
+                existing.add(r[0])
+                new_rows.append(r)
+        skipped = len(rows) - len(new_rows)
         
-        row_idx = cell.row
-        headers = detail_ws.row_values(1)
-        try:
-            status_col = headers.index("ESTATUS_ITEM") + 1
-            date_col = headers.index("FECHA_ESCANEO") + 1 # Update scan time? Or maybe add a 'RETURN_DATE'?
-            # Let's just update the status and keep original scan date, or maybe we need a history.
-            # For simplicity, we update status.
-        except ValueError:
-            return False, "Error en estructura de hoja de detalles."
-
-        detail_ws.update_cell(row_idx, status_col, new_status)
-        return True, f"Estatus actualizado a {new_status}"
+        if new_rows:
+            dm.with_retry(detail_ws.append_rows, new_rows, retry_on=dm.APPEND_RETRYABLE_STATUS)
+        return True, f"{len(new_rows)} QR registrados. {skipped} ya existían."
+    except dm.QuotaExceeded:
+        raise
     except Exception as e:
-        return False, f"Error actualizando QR: {e}"
+        return False, f"Error registrando QRs: {e}"
 
-def delete_qr_scan(detail_ws, qr_data):
+@dm.serialized_write
+def delete_qr_scans(detail_ws, qr_values):
     """
-    Deletes a specific QR record (soft delete or hard delete).
-    Here we'll do hard delete for simplicity in the list.
+    Soft-deletes several QR records with one read and one values write.
     """
     try:
-        cell = detail_ws.find(qr_data)
-        if not cell:
+        wanted = set(qr_values)
+        rows = [i for i, qr in _live_qr_rows(detail_ws) if qr in wanted]
+        if not rows:
             return False, "QR no encontrado para eliminar."
         
-        detail_ws.delete_rows(cell.row)
-        return True, "Registro eliminado correctamente."
+        dm.tombstone_rows(detail_ws, rows)
+        get_detail_header_map.clear() # The DELETED header may have just been added
+        return True, f"{len(rows)} registros eliminados."
+    except dm.QuotaExceeded:
+        raise
     except Exception as e:
-        return False, f"Error eliminando registro: {e}"
+        return False, f"Error eliminando registros: {e}"
+
+@st.cache_data(ttl=60) # One read of the detail sheet shared by every folio view
+def load_detail_frame(_detail_ws):
+    """
+    Returns the whole detail sheet as a DataFrame of strings.
+    Read errors propagate, so a failed read isn't cached as an empty sheet; callers handle them.
+    """
+    # Use retry wrapper from data_manager
+    all_values = dm.with_retry(_detail_ws.get_all_values)
+    if not all_values or len(all_values) < 2:
+        return pd.DataFrame(columns=DETAIL_COLUMNS)
+    df = pd.DataFrame(all_values[1:], columns=all_values[0], dtype="string[pyarrow]")
+    if "DELETED" in df.columns:
+        df = df[df["DELETED"] != dm.DELETED_FLAG]
+    return df
 
 @st.cache_data(ttl=60) # Cache detail counts for 1 min
 def get_all_detail_counts(_detail_ws):
     """
-    Returns a dictionary mapping FOLIO_PADRE to count of records.
-    Optimized for batch display.
+    Returns a Series of record counts indexed by FOLIO_PADRE (as str).
+    One sheet read for all folios, so it can be mapped onto the master list.
     """
-    try:
-        # Use retry wrapper from data_manager
-        all_values = dm.with_retry(_detail_ws.get_all_values)
-        if not all_values or len(all_values) < 2:
-            return {}
-            
-        headers = all_values[0]
-        try:
-            folio_idx = headers.index("FOLIO_PADRE")
-        except ValueError:
-            return {}
-            
-        counts = {}
-        for row in all_values[1:]:
-            if len(row) > folio_idx:
-                folio = row[folio_idx]
-                if folio:
-                    counts[folio] = counts.get(folio, 0) + 1
-        return counts
-    except Exception as e:
-        return {}
+    df = load_detail_frame(_detail_ws)
+    if "FOLIO_PADRE" not in df.columns:
+        return pd.Series(dtype="int64")
+    folios = df["FOLIO_PADRE"]
+    return folios[folios != ""].value_counts()
 
-def get_folio_details(detail_ws, folio):
+@st.cache_data(ttl=60) # Cache per folio; cleared on register/delete
+def get_folio_details(_detail_ws, folio):
     """
     Retrieves all QR records associated with a specific Folio.
+    Filtered from the shared detail frame, so opening another folio doesn't refetch the sheet.
     """
-    try:
-        # Get all records
-        all_records = detail_ws.get_all_records()
-        df = pd.DataFrame(all_records)
-        
-        if df.empty or "FOLIO_PADRE" not in df.columns:
-            return pd.DataFrame()
-            
-        # Filter by Folio (convert to string to be safe)
-        filtered_df = df[df["FOLIO_PADRE"].astype(str) == str(folio)]
-        return filtered_df
-    except Exception as e:
-        st.error(f"Error fetching details: {e}")
+    df = load_detail_frame(_detail_ws)
+    if df.empty or "FOLIO_PADRE" not in df.columns:
         return pd.DataFrame()
+    return df[df["FOLIO_PADRE"] == str(folio)]
+
+def purge_deleted_qrs(detail_ws):
+    """
+    Removes soft-deleted QR rows from the sheet (maintenance).
+    """
+    return dm.purge_deleted_rows(detail_ws)
+
+def clear_detail_cache():
+    """
+    Invalidates the detail sheet and everything derived from it. Call after any write.
+    """
+    load_detail_frame.clear()
+    get_registered_qrs.clear()
+    get_all_detail_counts.clear()
+    get_folio_details.clear()